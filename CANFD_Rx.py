@@ -1,28 +1,195 @@
 from PCANBasic import *
 import os
+import platform
+import select
 import sys
-from ctypes import c_ulonglong
+import threading
+import time
+from binascii import hexlify
+from queue import Empty, SimpleQueue
+
+# Data length in bytes for each CAN FD Data Length Code (0..15)
+_DLC_LEN = (0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64)
+
+# MSGTYPE flags as plain ints, avoiding ctypes attribute access per message
+_EXT = PCAN_MESSAGE_EXTENDED.value
+_RTR = PCAN_MESSAGE_RTR.value
+_EXT_RTR = _EXT | _RTR
+
+# Frame type names, indexed by the EXTENDED/RTR bits of a MSGTYPE
+_TYPE_LABELS = {
+    0: b"Standard Frame",
+    _EXT: b"Extended Frame",
+    _RTR: b"RTR Frame (Standard ID)",
+    _EXT_RTR: b"RTR Frame (Extended ID)",
+}
+
+# ID masks, indexed by the EXTENDED/RTR bits of a MSGTYPE
+_ID_MASKS = {
+    0: 0x7FF,
+    _EXT: 0xFFFFFFFF,
+    _RTR: 0x7FF,
+    _EXT_RTR: 0xFFFFFFFF,
+}
+
+# Layout of one received message as printed by the reader. The timestamp is
+# printed as raw microseconds.
+_MESSAGE_FORMAT = (
+    b"Type: %s\n"
+    b"ID: %X\n"
+    b"Length: %d\n"
+    b"Time: %d us\n"
+    b"Data: %s\n"
+    b"----------------------------------------------------------\n"
+)
+
+# CAN FD bit timing strings for a 20 MHz clock, keyed by (nominal kbit/s, data Mbit/s)
+_FD_BITRATES = {
+    # Default: the timing this reader has always used (20 MHz / 5 / 16 tq nominal).
+    # Sample points: nominal 87.5%, data 80%
+    (250, 2): b"f_clock_mhz=20, nom_brp=5, nom_tseg1=13, nom_tseg2=2, nom_sjw=2, data_brp=1, data_tseg1=7, data_tseg2=2, data_sjw=1",
+    # Sample points: nominal 75%, data 80%
+    (500, 2): b"f_clock_mhz=20, nom_brp=2, nom_tseg1=14, nom_tseg2=5, nom_sjw=4, data_brp=1, data_tseg1=7, data_tseg2=2, data_sjw=1",
+    # Sample points: nominal 75%, data 80%
+    (500, 4): b"f_clock_mhz=20, nom_brp=2, nom_tseg1=14, nom_tseg2=5, nom_sjw=4, data_brp=1, data_tseg1=3, data_tseg2=1, data_sjw=1",
+    # Sample points: nominal 75%, data 75%
+    (500, 5): b"f_clock_mhz=20, nom_brp=2, nom_tseg1=14, nom_tseg2=5, nom_sjw=4, data_brp=1, data_tseg1=2, data_tseg2=1, data_sjw=1",
+    # Sample points: nominal 75%, data 80%
+    (1000, 2): b"f_clock_mhz=20, nom_brp=1, nom_tseg1=14, nom_tseg2=5, nom_sjw=4, data_brp=1, data_tseg1=7, data_tseg2=2, data_sjw=1",
+    # Sample points: nominal 75%, data 80%
+    (1000, 4): b"f_clock_mhz=20, nom_brp=1, nom_tseg1=14, nom_tseg2=5, nom_sjw=4, data_brp=1, data_tseg1=3, data_tseg2=1, data_sjw=1",
+}
+
+def _format_message_fd(msgtype, id, dlc, data, micros):
+    """
+    Formats a received CAN FD message in a single pass
+
+    Parameters:
+        msgtype: The type of the CAN message
+        id: Id of the CAN message
+        dlc: Data Length Code
+        data: Data of the CAN message as a bytes-like object
+        micros: Timestamp of the message as microseconds
+
+    Returns:
+        The printable message as ASCII bytes
+    """
+    kind = msgtype & _EXT_RTR
+    length = _DLC_LEN[dlc & 0xF]
+    if kind & _RTR:
+        text = b"Remote Request"
+    else:
+        text = hexlify(data[:length], b" ").upper()
+    return _MESSAGE_FORMAT % (
+        _TYPE_LABELS[kind],
+        id & _ID_MASKS[kind],
+        length,
+        micros,
+        text,
+    )
 
 class CANFDReader:
     # Defines
     #region
 
+    # The defines are class attributes and can't be assigned on an instance
+    # (see __slots__). Change them on the class or a subclass before creating
+    # the reader, e.g.:
+    #   class RealtimeReader(CANFDReader):
+    #       ReaderCpu = 3
+    #       ReaderPriority = 50
+
     # Sets the PCANHandle (Hardware Channel)
     PcanHandle = PCAN_USBBUS1
 
-    # Sets the bitrate for CAN FD devices.
-    # Nominal Bitrate: 500 kbps, Data Bitrate: 2 Mbps
-    # Prescaler: 5, Sample Point: 75%
-    BitrateFD = b"f_clock_mhz=20, nom_brp=5, nom_tseg1=13, nom_tseg2=2, nom_sjw=2, data_brp=1, data_tseg1=7, data_tseg2=2, data_sjw=1"
+    # Size in bytes at which the output buffer is written to stdout
+    OutputFlushSize = 64 * 1024
+
+    # Seconds to sleep when the receive queue is empty and no receive event is available
+    IdleSleep = 0.0005
+
+    # Maximum number of received messages waiting to be printed. When it is full new
+    # messages are dropped and counted in dropped_messages.
+    PrintQueueSize = 65536
+
+    # Maximum number of messages formatted between two checks of the output buffer
+    PrintBatchSize = 256
+
+    # Minimum seconds between two reports of the dropped message count
+    DropReportInterval = 1.0
+
+    # Seconds to wait for the receive event before polling the queue again
+    ReceiveEventTimeout = 1.0
+
+    # CPU core the receive loop is pinned to, e.g. 3 (None leaves the affinity unchanged)
+    ReaderCpu = None
+
+    # SCHED_FIFO priority of the receive loop, e.g. 50 (None keeps the default scheduler).
+    # Opt-in, since a real-time thread can starve other work on its core.
+    # Linux only; requires root or the CAP_SYS_NICE capability.
+    ReaderPriority = None
+
+    #endregion
+
+    # Members
+    #region
+
+    # Fixed attribute layout for faster access from the receive loop. Instances
+    # have no __dict__, so the defines above are read-only on an instance.
+    __slots__ = (
+        "m_objPCANBasic",
+        "BitrateFD",
+        "_out_buf",
+        "_msg",
+        "_ts",
+        "_msg_ref",
+        "_ts_ref",
+        "_data_view",
+        "_CAN_ReadFD",
+        "_err_cache",
+        "_wait_for_message",
+        "_queue",
+        "dropped_messages",
+    )
 
     #endregion
 
-    def __init__(self):
+    def __init__(self, nom_kbps=250, data_mbps=2):
         """
         Initializes the CAN FD reader
+
+        Parameters:
+            nom_kbps: Nominal bitrate in kbit/s (the default keeps the original timing string)
+            data_mbps: Data bitrate in Mbit/s
         """
+        # Sets the bitrate for CAN FD devices
+        try:
+            self.BitrateFD = _FD_BITRATES[(nom_kbps, data_mbps)]
+        except KeyError:
+            raise KeyError(f"Unsupported CAN FD bitrate {nom_kbps} kbit/s / {data_mbps} Mbit/s. "
+                           f"Supported (kbit/s, Mbit/s): {sorted(_FD_BITRATES)}") from None
         self.m_objPCANBasic = PCANBasic()
+        self._out_buf = bytearray()
+
+        # Error texts already retrieved from the driver, keyed by status code
+        self._err_cache = {}
+
+        # Received messages handed from the receive loop to the printer thread
+        self._queue = SimpleQueue()
+        self.dropped_messages = 0
+
+        # Message and timestamp reused by every read, so the receive loop
+        # calls CAN_ReadFD directly instead of allocating them per message
+        self._msg = TPCANMsgFD()
+        self._ts = TPCANTimestampFD()
+        self._msg_ref = byref(self._msg)
+        self._ts_ref = byref(self._ts)
+        self._data_view = memoryview(self._msg.DATA).cast("B")
+        self._CAN_ReadFD = self.m_objPCANBasic._PCANBasic__m_dllBasic.CAN_ReadFD
+        self._CAN_ReadFD.argtypes = [TPCANHandle, POINTER(TPCANMsgFD), POINTER(TPCANTimestampFD)]
+        self._wait_for_message = None
         self.initialize_channel()
+        self.initialize_receive_event()
 
     def initialize_channel(self):
         """
@@ -38,46 +205,175 @@ class CANFDReader:
         print("Successfully initialized.")
         
         # Set message filter to allow all messages
-        stsResult = self.m_objPCANBasic.SetValue(self.PcanHandle, PCAN_MESSAGE_FILTER, PCAN_FILTER_CLOSE)
-        if stsResult != PCAN_ERROR_OK:
-            print("Cannot set message filter to close.")
-            self.show_status(stsResult)
-            sys.exit()
-
         stsResult = self.m_objPCANBasic.SetValue(self.PcanHandle, PCAN_MESSAGE_FILTER, PCAN_FILTER_OPEN)
         if stsResult != PCAN_ERROR_OK:
             print("Cannot set message filter to open.")
             self.show_status(stsResult)
             sys.exit()
 
+    def initialize_receive_event(self):
+        """
+        Binds an OS wait object to the driver's receive event, falling back to polling
+        """
+        if platform.system() == 'Windows':
+            kernel32 = windll.kernel32
+            kernel32.CreateEventW.restype = c_void_p
+            kernel32.WaitForSingleObject.argtypes = [c_void_p, c_uint]
+            event = kernel32.CreateEventW(None, False, False, None)
+            if not event:
+                print("Cannot create the receive event. Polling instead.")
+                return
+            stsResult = self.m_objPCANBasic.SetValue(self.PcanHandle, PCAN_RECEIVE_EVENT, event)
+            if stsResult != PCAN_ERROR_OK:
+                print("Cannot set the receive event. Polling instead.")
+                kernel32.CloseHandle(c_void_p(event))
+                return
+            timeout = int(self.ReceiveEventTimeout * 1000)
+            self._wait_for_message = lambda: kernel32.WaitForSingleObject(event, timeout)
+        else:
+            # On Linux the driver exposes the receive event as a file descriptor
+            stsResult, fd = self.m_objPCANBasic.GetValue(self.PcanHandle, PCAN_RECEIVE_EVENT)
+            if stsResult != PCAN_ERROR_OK:
+                print("Cannot get the receive event. Polling instead.")
+                return
+            timeout = self.ReceiveEventTimeout
+            self._wait_for_message = lambda: select.select([fd], [], [], timeout)
+
+    def configure_scheduling(self):
+        """
+        Pins the receive loop to a CPU core and raises its scheduling priority
+        """
+        if self.ReaderCpu is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, {self.ReaderCpu})
+            except OSError as e:
+                print(f"Cannot pin the reader to CPU {self.ReaderCpu}: {e}")
+
+        if self.ReaderPriority is not None and hasattr(os, "sched_setscheduler"):
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.ReaderPriority))
+            except OSError as e:
+                print(f"Cannot set SCHED_FIFO priority {self.ReaderPriority} (CAP_SYS_NICE required): {e}")
+
     def read_messages(self):
         """
         Reads CAN FD messages from the bus
         """
-        while True:
-            stsResult = self.m_objPCANBasic.ReadFD(self.PcanHandle)
-            if stsResult[0] != PCAN_ERROR_QRCVEMPTY:
-                if stsResult[0] == PCAN_ERROR_OK:
-                    self.process_message_fd(stsResult[1], stsResult[2])
+        # Started before configure_scheduling so the printer doesn't inherit
+        # the receive loop's CPU pinning and real-time priority
+        printer = threading.Thread(target=self.print_messages, name="CANFDPrinter", daemon=True)
+        printer.start()
+        self.configure_scheduling()
+
+        # Bind everything the loop touches to locals once. Status codes go through
+        # the print queue so they are shown after the messages received before them.
+        read, process, show = self._CAN_ReadFD, self.process_message_fd, self._queue.put
+        handle, msg, ts, msg_ref, ts_ref = self.PcanHandle, self._msg, self._ts, self._msg_ref, self._ts_ref
+        OK, EMPTY = PCAN_ERROR_OK, PCAN_ERROR_QRCVEMPTY
+        FATAL = PCAN_ERROR_ILLHANDLE | PCAN_ERROR_INITIALIZE
+        wait = self._wait_for_message
+        if wait is None:
+            idle_sleep = self.IdleSleep
+            wait = lambda: time.sleep(idle_sleep)
+        # Bus status last reported along with an empty queue, and the last other error
+        last_bus_status = last_error = OK
+        try:
+            while True:
+                stsResult = read(handle, msg_ref, ts_ref)
+                if stsResult == OK:
+                    process(msg, ts)
+                    last_error = OK
+                elif stsResult & EMPTY:
+                    # Queue drained, possibly with bus status bits (e.g. BUSOFF). Report
+                    # those only when they change, then block until the next message
+                    bus_status = stsResult & ~EMPTY
+                    if bus_status != last_bus_status:
+                        if bus_status:
+                            show(bus_status)
+                        last_bus_status = bus_status
+                    wait()
+                elif stsResult != last_error:
+                    show(stsResult)
+                    # The channel is gone, so reading again can't succeed
+                    if stsResult & FATAL:
+                        return
+                    # Errors like OVERRUN/QOVERRUN mean frames are still queued,
+                    # so read again at once
+                    last_error = stsResult
                 else:
-                    self.show_status(stsResult[0])
-            else:
-                print("No messages received. Waiting...")
+                    # The same error again: back off instead of spinning on it
+                    wait()
+        finally:
+            # Let the printer drain what is already queued, then stop
+            self._queue.put(None)
+            printer.join()
 
     def process_message_fd(self, msg, timestamp):
         """
-        Processes a received CAN FD message
+        Queues a received CAN FD message for the printer thread
 
         Parameters:
             msg: The received PCAN-Basic CAN-FD message
             timestamp: Timestamp of the message as microseconds (ulong)
         """
-        print("Type: " + self.get_type_string(msg.MSGTYPE))
-        print("ID: " + self.get_id_string(msg.ID, msg.MSGTYPE))
-        print("Length: " + str(self.get_length_from_dlc(msg.DLC)))
-        print("Time: " + self.get_time_string(timestamp))
-        print("Data: " + self.get_data_string(msg.DATA, msg.DLC, msg.MSGTYPE))
-        print("----------------------------------------------------------")
+        queue = self._queue
+        if queue.qsize() >= self.PrintQueueSize:
+            self.dropped_messages += 1
+            return
+        dlc = msg.DLC
+        data = self._data_view if msg is self._msg else memoryview(msg.DATA).cast("B")
+        # The message structure is reused by the next read, so copy its fields
+        # (only the used data bytes)
+        queue.put((msg.MSGTYPE, msg.ID, dlc, data[:_DLC_LEN[dlc & 0xF]].tobytes(), timestamp.value))
+
+    def print_messages(self):
+        """
+        Formats and prints queued messages and status codes until the reader stops
+        """
+        queue, out = self._queue, self._out_buf
+        get, get_nowait = queue.get, queue.get_nowait
+        reported, next_report = 0, 0.0
+        while True:
+            # Block until there is work, then take up to a batch without blocking
+            batch = [get()]
+            try:
+                for _ in range(self.PrintBatchSize - 1):
+                    batch.append(get_nowait())
+            except Empty:
+                pass
+            for item in batch:
+                # None is queued by read_messages once it stops reading
+                if item is None:
+                    self.flush_output()
+                    if self.dropped_messages != reported:
+                        print(f"{self.dropped_messages} messages dropped (print queue full).")
+                    return
+                # A plain int is a status code queued by read_messages
+                if item.__class__ is int:
+                    self.flush_output()
+                    self.show_status(item)
+                else:
+                    out += _format_message_fd(*item)
+            if len(out) > self.OutputFlushSize or queue.empty():
+                self.flush_output()
+            # Drops only happen while the queue stays full, so report them from
+            # every batch, at most once per DropReportInterval
+            if self.dropped_messages != reported:
+                now = time.monotonic()
+                if now >= next_report:
+                    reported, next_report = self.dropped_messages, now + self.DropReportInterval
+                    self.flush_output()
+                    print(f"{reported} messages dropped so far (print queue full).")
+
+    def flush_output(self):
+        """
+        Writes the buffered message output to stdout in a single call
+        """
+        if self._out_buf:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(self._out_buf)
+            sys.stdout.buffer.flush()
+            self._out_buf.clear()
 
     def show_status(self, status):
         """
@@ -89,7 +385,7 @@ class CANFDReader:
         print("=========================================================================================")
         error_text = self.get_formatted_error(status)
         print(error_text)
-        if b"Bus error" in error_text:
+        if status & PCAN_ERROR_ANYBUSERR:
             print("Suggested actions:")
             print("1. Check CAN bus termination.")
             print("2. Ensure all devices use the same bitrate.")
@@ -106,108 +402,17 @@ class CANFDReader:
         Returns:
             The formatted error code as string
         """
+        error_text = self._err_cache.get(error)
+        if error_text is not None:
+            return error_text
+
         stsReturn = self.m_objPCANBasic.GetErrorText(error, 0x09)
         if stsReturn[0] != PCAN_ERROR_OK:
             return f"An error occurred. Error-code's text ({error:X}) couldn't be retrieved"
         else:
+            self._err_cache[error] = stsReturn[1]
             return stsReturn[1]
 
-    def get_type_string(self, msgtype):
-        """
-        Gets the name of a MSGTYPE
-
-        Parameters:
-            msgtype: The type to be converted
-
-        Returns:
-            The type name as string
-        """
-        if (msgtype & PCAN_MESSAGE_EXTENDED.value) == PCAN_MESSAGE_EXTENDED.value:
-            if (msgtype & PCAN_MESSAGE_RTR.value) == PCAN_MESSAGE_RTR.value:
-                return "RTR Frame (Extended ID)"
-            else:
-                return "Extended Frame"
-        elif (msgtype & PCAN_MESSAGE_RTR.value) == PCAN_MESSAGE_RTR.value:
-            return "RTR Frame (Standard ID)"
-        else:
-            return "Standard Frame"
-
-    def get_id_string(self, id, msgtype):
-        """
-        Gets the string representation of the ID of a CAN message
-
-        Parameters:
-            id: Id to be converted
-            msgtype: The type of the CAN message
-
-        Returns:
-            The ID of the CAN message as string
-        """
-        if (msgtype & PCAN_MESSAGE_EXTENDED.value) == PCAN_MESSAGE_EXTENDED.value:
-            return f"{id:X}"
-        else:
-            return f"{id & 0x7FF:X}"
-
-    def get_time_string(self, time):
-        """
-        Gets the string representation of the timestamp of a CAN message
-
-        Parameters:
-            time: Time to be converted
-
-        Returns:
-            The timestamp of the CAN message as string
-        """
-        # Convert the bytes object to a c_ulonglong and then to a native Python int
-        dSeconds = c_ulonglong.from_buffer_copy(time).value / 1000000.0
-        return f"{dSeconds:.1f}"
-
-    def get_data_string(self, data, dlc, msgtype):
-        """
-        Gets the string representation of the data of a CAN message
-
-        Parameters:
-            data: Data to be converted
-            dlc: Data Length Code
-            msgtype: The type of the CAN message
-
-        Returns:
-            The data of the CAN message as string
-        """
-        if (msgtype & PCAN_MESSAGE_RTR.value) == PCAN_MESSAGE_RTR.value:
-            return "Remote Request"
-        else:
-            return " ".join(f"{byte:X}" for byte in data[:dlc])
-
-    def get_length_from_dlc(self, dlc):
-        """
-        Gets the length of the data from the DLC value of a CAN message
-
-        Parameters:
-            dlc: DLC value to be converted
-
-        Returns:
-            The length of the data
-        """
-        if dlc <= 8:
-            return dlc
-        elif dlc == 9:
-            return 12
-        elif dlc == 10:
-            return 16
-        elif dlc == 11:
-            return 20
-        elif dlc == 12:
-            return 24
-        elif dlc == 13:
-            return 32
-        elif dlc == 14:
-            return 48
-        elif dlc == 15:
-            return 64
-        else:
-            return 0
-
 if __name__ == "__main__":
     reader = CANFDReader()
     reader.read_messages()
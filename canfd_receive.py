@@ -1,40 +1,42 @@
+import asyncio
 import can
 
-def receive_can_fd_messages():
+# Number of received messages collected before they are printed in one write
+BATCH_SIZE = 100
+
+async def receive_can_fd_messages():
     # Create a CAN bus instance
     bus = can.interface.Bus(bustype='pcan', channel='PCAN_USBBUS1', can_fd = True, bitrate=500000)
-    
-    # Create a listener that will handle the received messages
-    class FDListener(can.Listener):
-        def on_message_received(self, msg):
-            if msg.is_fd:
-                print(f"Received CAN FD message: {msg}")
-        
-        def stop(self):
-            # Implement the abstract stop method
-            pass
-
-    listener = FDListener()
-
-    # Create a notifier to dispatch received messages to the listener
-    notifier = can.Notifier(bus, [listener])
+
+    # Create a reader that queues the received messages for the event loop
+    reader = can.AsyncBufferedReader()
+
+    # Create a notifier to dispatch received messages to the reader.
+    # The notifier is the only consumer of the bus: calling bus.recv() while it
+    # runs would split or duplicate the received messages.
+    notifier = can.Notifier(bus, [reader], loop=asyncio.get_running_loop())
 
     print("Listening for CAN FD messages...")
-    
-    try:
-        while True:
-            # Receive a message
-            message = bus.recv(timeout=1)  # Timeout in seconds
-            if message is not None and message.is_fd:
-                print(f"Received CAN FD message: {message}")
 
-    except KeyboardInterrupt:
-        print("Stopped listening for CAN FD messages.")
+    out = []
+    try:
+        async for message in reader:
+            if message.is_fd:
+                out.append(f"Received CAN FD message: {message}")
+            # Print once per batch, or as soon as the reader has caught up
+            if out and (len(out) >= BATCH_SIZE or reader.buffer.empty()):
+                print("\n".join(out))
+                out.clear()
 
     finally:
+        if out:
+            print("\n".join(out))
         # Cleanup
         notifier.stop()
         bus.shutdown()
 
 if __name__ == "__main__":
-    receive_can_fd_messages()
+    try:
+        asyncio.run(receive_can_fd_messages())
+    except KeyboardInterrupt:
+        print("Stopped listening for CAN FD messages.")